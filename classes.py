@@ -1,18 +1,63 @@
-from graphviz import Digraph
 from typing import Callable
-from igraph import Graph
+from contextlib import contextmanager
+from tool.functions import _json_loads, _json_dumps
 from html import escape
+import tempfile
 import pickle
-import json
+import weakref
+import mmap
+import time
 import os
 
+_UMASK = os.umask(0)
+os.umask(_UMASK)
+
+@contextmanager
+def _atomic_open(path: str, sync: bool = False, buffering: int = -1):
+    '''
+    Open a unique temporary file next to path for binary writing, and move it over path once the block succeeds.
+    Concurrent writers never share a temporary file, and the temporary file is removed if the write fails.
+    '''
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or '.', prefix=os.path.basename(path) + '.', suffix='.tmp')
+    try:
+        os.chmod(tmp_path, 0o666 & ~_UMASK)     # mkstemp creates 0600 files, keep the permissions open() would give
+        with os.fdopen(fd, 'wb', buffering=buffering) as f:
+            yield f
+            if sync:
+                f.flush()
+                os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.unlink(tmp_path)
+        except OSError:
+            pass
+        raise
+
+def _flush_records(log_path: str, logs: list[dict], sync: bool = False):
+    ''' Write the records of a Log to a temporary file in a single write, then move it over 'idx.log'. '''
+    blob = b''.join(_json_dumps(js) + b'\n' for js in logs)
+    with _atomic_open(log_path, sync) as f:
+        f.write(blob)
+
+def _flush_pending(log_path: str, logs: list[dict], state: dict):
+    ''' Finalizer of a Log: durably write its records, only if some updates have not been written yet. '''
+    if state['dirty']:
+        _flush_records(log_path, logs, sync=True)
+        state['dirty'] = 0
+
 class Log:
+    flush_interval = 0.05   # seconds between two rewrites of 'idx.log'
+    flush_every = 64        # or after this many pending updates
+
     def __init__(self, output_path: str):
         '''
         Usage:
             Create a log file.
             It is used to keep track of the last index.
             So that we don not need to generate the data from scratch every time.
+            Updates are buffered and written to disk every `flush_every` calls or `flush_interval` seconds.
+            The file is always replaced atomically, a crash never leaves a half written 'idx.log'.
 
         Parameters:
             :output_path: the path of the output file.
@@ -20,8 +65,8 @@ class Log:
         Returns:
             A file named 'idx.log' in the same directory as the output file.
             Example:
-                {"filename": "train.jsonl", "idx": 110}
-                {"filename": "dev.jsonl", "idx": 0}
+                {"filename":"train.jsonl","idx":110}
+                {"filename":"dev.jsonl","idx":0}
         '''
         dirname = os.path.dirname(output_path)
         basename = os.path.basename(output_path)
@@ -32,14 +77,20 @@ class Log:
             os.makedirs(dirname)
         self.logs = []
         if os.path.exists(log_path):
-            with open(log_path, 'r', encoding='utf-8') as f_r:
+            with open(log_path, 'rb') as f_r:
                 for line in f_r:
-                    js = json.loads(line)
+                    if not line.strip():
+                        continue
+                    js = _json_loads(line)
                     if js['filename'] == basename:
                         self.last_idx = int(js['idx'])
                     else:
                         self.logs.append(js)
         self.logs.append({'filename': basename, 'idx': self.last_idx})
+        self._state = {'dirty': 0}     # pending updates, shared with the finalizer
+        self._last_flush = time.monotonic()
+        # flush pending updates when the Log is garbage collected or at exit, without keeping the Log itself alive
+        self._finalizer = weakref.finalize(self, _flush_pending, log_path, self.logs, self._state)
 
     def update(self, idx: int):
         '''
@@ -50,13 +101,13 @@ class Log:
             :idx: the new index.
 
         Returns:
-            Rewrite the 'idx.log' file with the new index.
+            Rewrite the 'idx.log' file with the new index once enough updates are pending.
         '''
-        with open(self.log_path, 'w', encoding='utf-8') as f_a:
-            self.logs[-1]['idx'] = idx
-            for js in self.logs:
-                f_a.write(json.dumps(js, ensure_ascii=False) + '\n')
+        self.logs[-1]['idx'] = idx
         self.last_idx = idx
+        self._state['dirty'] += 1
+        if self._state['dirty'] >= self.flush_every or time.monotonic() - self._last_flush >= self.flush_interval:
+            self.flush()
 
     def set_zero(self):
         '''
@@ -68,12 +119,32 @@ class Log:
         '''
         self.last_idx = 0
         self.logs[-1]['idx'] = 0
-        with open(self.log_path, 'w', encoding='utf-8') as f_a:
-            for js in self.logs:
-                f_a.write(json.dumps(js, ensure_ascii=False) + '\n')
+        self.flush(sync=True)
+
+    def flush(self, sync: bool = False):
+        '''
+        Usage:
+            Write all the records to a temporary file in a single write, then move it over 'idx.log'.
+
+        Parameters:
+            :sync: fsync the temporary file before replacing, so the new index survives a system crash.
+        '''
+        if not self._finalizer.alive:
+            return
+        _flush_records(self.log_path, self.logs, sync)
+        self._state['dirty'] = 0
+        self._last_flush = time.monotonic()
+
+    def close(self):
+        '''
+        Usage:
+            Durably write the pending updates, later updates are no longer saved.
+        '''
+        self._finalizer()
 
 class VisableGraph:
     def __init__(self):
+        from igraph import Graph
         self.graph = Graph(directed=True)
 
     def node(self, id: int, **attrs):
@@ -167,34 +238,92 @@ class VisableGraph:
         Example:
             render(lambda node: node['label'], lambda edge: edge['label'], 'output.pdf')
         '''
+        from graphviz import Digraph
         dot = Digraph(comment=filename)
-        for node in self.graph.vs:
-            node_attr = node.attributes()
-            node_label = escape(node_property(node_attr))
-            if 'dot_kwargs' in node_attr and node_attr['dot_kwargs']:
-                dot.node(str(node.index), node_label, **node_attr['dot_kwargs'])
+        vs, es = self.graph.vs, self.graph.es
+        _escape = escape
+
+        # read every attribute as a whole column instead of one vertex / edge at a time
+        node_names = vs.attributes()
+        node_columns = zip(*[vs[name] for name in node_names]) if node_names else [()] * len(vs)
+        node_has_kwargs = 'dot_kwargs' in node_names
+        for index, values in enumerate(node_columns):
+            node_attr = dict(zip(node_names, values))
+            node_label = _escape(node_property(node_attr))
+            if node_has_kwargs and node_attr['dot_kwargs']:
+                dot.node(str(index), node_label, **node_attr['dot_kwargs'])
             else:
-                dot.node(str(node.index), node_label)
+                dot.node(str(index), node_label)
             
-        for edge in self.graph.es:
-            edge_attr = edge.attributes()
-            edge_label = escape(edge_property(edge_attr)) if edge_property else ''
-            if 'dot_kwargs' in edge_attr and edge_attr['dot_kwargs']:
-                dot.edge(str(edge.source), str(edge.target), edge_label, **edge_attr['dot_kwargs'])
+        edge_names = es.attributes()
+        edge_columns = zip(*[es[name] for name in edge_names]) if edge_names else [()] * len(es)
+        edge_has_kwargs = 'dot_kwargs' in edge_names
+        for (source, target), values in zip(self.graph.get_edgelist(), edge_columns):
+            edge_attr = dict(zip(edge_names, values))
+            edge_label = _escape(edge_property(edge_attr)) if edge_property else ''
+            if edge_has_kwargs and edge_attr['dot_kwargs']:
+                dot.edge(str(source), str(target), edge_label, **edge_attr['dot_kwargs'])
             else:
-                dot.edge(str(edge.source), str(edge.target), edge_label,)
+                dot.edge(str(source), str(target), edge_label,)
             
         dot.render(filename, view=True, cleanup=True)
 
     def save(self, output_dir: str='output'):
+        '''
+        Usage:
+            Save the graph to 'graph.pkl' in the output directory.
+            Large buffers (e.g. numpy attributes) are pickled out-of-band into 'graph.buffers'.
+        '''
         if not os.path.exists(output_dir):
             os.makedirs(output_dir, exist_ok=True)
-        with open(f'{output_dir}/graph.pkl', 'wb') as f:
-            pickle.dump(self.graph, f)
+        buffers = []
+        with open(f'{output_dir}/graph.pkl', 'wb', buffering=1 << 20) as f:
+            pickle.dump(self.graph, f, protocol=pickle.HIGHEST_PROTOCOL, buffer_callback=buffers.append)
+
+        buffers_path = f'{output_dir}/graph.buffers'
+        if buffers:
+            # never truncate 'graph.buffers' in place, a loaded graph may still be mapping it
+            with _atomic_open(buffers_path, buffering=1 << 20) as f:
+                for buffer in buffers:
+                    data = buffer.raw()
+                    f.write(data.nbytes.to_bytes(8, 'little'))
+                    f.write(data)
+        elif os.path.exists(buffers_path):
+            os.remove(buffers_path)
     
-    def load(self, input_dir: str='output'):
+    def load(self, input_dir: str='output', mmap_buffers: bool=False):
+        '''
+        Usage:
+            Load the graph saved by `save` from the input directory.
+
+        Parameters:
+            :input_dir: the directory containing 'graph.pkl' (and 'graph.buffers' if any).
+            :mmap_buffers: map 'graph.buffers' copy-on-write instead of reading it, large arrays are then paged in on demand.
+                The mapping lives as long as any loaded array, so the file stays mapped after `load` returns.
+                On Windows a mapped file can not be replaced or removed, a later `save` to the same directory fails.
+        '''
+        buffers = None
+        buffers_path = f'{input_dir}/graph.buffers'
+        if os.path.exists(buffers_path) and mmap_buffers:
+            with open(buffers_path, 'rb') as f:
+                view = memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY))
+            buffers, offset = [], 0
+            while offset < len(view):
+                size = int.from_bytes(view[offset:offset+8], 'little')
+                buffers.append(view[offset+8:offset+8+size])
+                offset += 8 + size
+        elif os.path.exists(buffers_path):
+            buffers = []
+            with open(buffers_path, 'rb') as f:
+                while True:
+                    header = f.read(8)
+                    if not header:
+                        break
+                    buffer = bytearray(int.from_bytes(header, 'little'))
+                    f.readinto(buffer)
+                    buffers.append(buffer)
         with open(f'{input_dir}/graph.pkl', 'rb') as f:
-            self.graph = pickle.load(f)
+            self.graph = pickle.load(f, buffers=buffers)
 
     def help(self):
         print('See igraph documentation at https://python.igraph.org/en/latest/tutorial.html')
@@ -1,48 +1,118 @@
-from tool.functions import query_stream
 from typing import Callable, Any
-from functools import wraps
+from functools import wraps, lru_cache
+from time import perf_counter_ns
+import threading
+import itertools
+import linecache
+import textwrap
+import inspect
+import random
 import time
 import sys
 import os
 
 counter_funcs = []
+_wrapper_ids = itertools.count()
+
+def _specialize(func: Callable, body: str, **namespace) -> Callable:
+    '''
+    Build a wrapper of func from the source of its body, `$call` in the body stands for the call to func.
+    The wrapper declares the same parameters as func, so a call does not pack a new args tuple and kwargs dict.
+    Fall back to a (*args, **kwargs) wrapper when the signature of func can not be reproduced.
+    '''
+    body = textwrap.indent(textwrap.dedent(body).strip(), '    ')
+    namespace['func'] = func
+
+    def build(params: str, call: str) -> Callable:
+        source = f'def wrapper({params}):\n{body.replace("$call", call)}\n'
+        filename = f"<{getattr(func, '__qualname__', repr(func))} wrapper #{next(_wrapper_ids)}>"
+        # register the generated source so that tracebacks through the wrapper can show its lines
+        linecache.cache[filename] = (len(source), None, source.splitlines(True), filename)
+        exec(compile(source, filename, 'exec'), namespace)
+        return namespace.pop('wrapper')
+
+    wrapper = build('*args, **kwargs', 'func(*args, **kwargs)')
+    # a parameter may not shadow any name the body uses: locals, globals or builtins such as print
+    reserved = set(namespace) | set(wrapper.__code__.co_names) | (set(wrapper.__code__.co_varnames) - {'args', 'kwargs'})
+    try:
+        # do not follow __wrapped__: a functools.wraps decorator below may accept different arguments than the function it wraps
+        parameters = list(inspect.signature(func, follow_wrapped=False).parameters.values())
+    except (TypeError, ValueError):
+        return wraps(func)(wrapper)
+    if any(p.name in reserved for p in parameters):
+        return wraps(func)(wrapper)
+
+    params, call_args = [], []
+    for i, p in enumerate(parameters):
+        if p.kind is p.VAR_POSITIONAL:
+            params.append(f'*{p.name}')
+            call_args.append(f'*{p.name}')
+        elif p.kind is p.VAR_KEYWORD:
+            params.append(f'**{p.name}')
+            call_args.append(f'**{p.name}')
+        else:
+            if p.kind is p.KEYWORD_ONLY and (i == 0 or parameters[i-1].kind not in (p.KEYWORD_ONLY, p.VAR_POSITIONAL)):
+                params.append('*')
+            if p.default is p.empty:
+                params.append(p.name)
+            else:      # defaults are looked up in the namespace, their repr may not be valid source
+                namespace[f'__default_{i}'] = p.default
+                params.append(f'{p.name}=__default_{i}')
+            call_args.append(f'{p.name}={p.name}' if p.kind is p.KEYWORD_ONLY else p.name)
+        if p.kind is p.POSITIONAL_ONLY and (i + 1 == len(parameters) or parameters[i+1].kind is not p.POSITIONAL_ONLY):
+            params.append('/')
+
+    wrapper = build(', '.join(params), f'func({", ".join(call_args)})')
+    return wraps(func)(wrapper)
 
 def timer(func: Callable) -> Callable:
     ''' To measure the execution time of a function '''
-    @wraps(func)
-    def wrapper(*args, **kwargs):
-        start_time = time.time()
-        result = func(*args, **kwargs)
-        end_time = time.time()
-        print(f"{func.__name__}: {end_time - start_time: 0.4f} seconds")
+    return _specialize(func, '''
+        start_time = perf_counter_ns()
+        result = $call
+        end_time = perf_counter_ns()
+        print(f"{func.__name__}: {(end_time - start_time) * 1e-9: 0.4f} seconds")
         return result
-    return wrapper
+    ''', perf_counter_ns=perf_counter_ns)
 
 def counter(func: Callable) -> Callable:
     '''
     To count the times of a function is called and sum up the execution time, calculate the average execution time
+    The counters are updated under a lock, so the function can be called from several threads.
 
     Usage:
     @ counter
     def f():
         pass
 
-    print_func(f)
+    calls, times_ns = f.stats()
+    print_funcs()
+
+    Note: f.stats() replaces the former f.calls, f.times and f.avg_time attributes, which are no longer set.
     '''
     global counter_funcs
+    calls = 0       # call amount 
+    times_ns = 0    # total execution time in nanoseconds
+    lock = threading.Lock()
+
     @wraps(func)
     def wrapper(*args, **kwargs):
-        wrapper.calls += 1
-        start_time = time.time()
-        result = func(*args, **kwargs)
-        end_time = time.time()
-        wrapper.times += end_time - start_time
-        wrapper.avg_time = wrapper.times / wrapper.calls
-        return result
-
-    wrapper.calls = 0       # call amount 
-    wrapper.times = 0.0     # total execution time
-    wrapper.avg_time = 0.0  # average execution time
+        nonlocal calls, times_ns
+        start_time = perf_counter_ns()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            elapsed_ns = perf_counter_ns() - start_time
+            with lock:
+                calls += 1
+                times_ns += elapsed_ns
+
+    def stats():
+        ''' Return the call amount and the total execution time in nanoseconds. '''
+        with lock:
+            return calls, times_ns
+
+    wrapper.stats = stats
     for attr in ('__module__', '__name__', '__qualname__', '__doc__'):      # copy function attributes to wrapper
         setattr(wrapper, attr, getattr(func, attr))
         
@@ -54,10 +124,13 @@ def print_funcs() -> None:
     Print the information of a function, including call count, total execution time, and average execution time.
     '''
     for func in counter_funcs:
+        calls, times_ns = func.stats()
+        times = times_ns * 1e-9
+        avg_time = times / calls if calls else 0.0
         print(f"Func name: {func.__qualname__}")
-        print(f"call count: {func.calls}")
-        print(f"total time: {func.times: 0.4f} seconds")
-        print(f"average time: {func.avg_time: 0.4f} seconds\n")
+        print(f"call count: {calls}")
+        print(f"total time: {times: 0.4f} seconds")
+        print(f"average time: {avg_time: 0.4f} seconds\n")
 
 import atexit
 atexit.register(print_funcs)
@@ -69,31 +142,41 @@ def log(desc: str = "") -> Callable:
     :param desc: A description of the function that is being logged.
     '''
     def helper(func: Callable) -> Callable:
-        @wraps(func)
-        def wrapper(*args, **kwargs):
-            start_time = time.time()
+        return _specialize(func, '''
+            start_time = perf_counter_ns()
             if desc:
                 print(f"Starting {desc}...")
             else:
                 print(f"Calling  {func.__qualname__}")
-            result = func(*args, **kwargs)
+            result = $call
+            elapsed_time = (perf_counter_ns() - start_time) * 1e-9
             if desc:
-                print(f"Finished {desc} in {time.time() - start_time: 0.4f} seconds")
+                print(f"Finished {desc} in {elapsed_time: 0.4f} seconds")
             else:
-                print(f"Finished {func.__qualname__} in {time.time() - start_time: 0.4f} seconds")
+                print(f"Finished {func.__qualname__} in {elapsed_time: 0.4f} seconds")
             return result
-
-        return wrapper
+        ''', perf_counter_ns=perf_counter_ns, desc=desc)
 
     return helper
 
 
-def retry(retries: int = 3, delay: float = 1) -> Callable:
+def retry(
+    retries: int = 3,
+    delay: float = 1,
+    on: tuple[type[BaseException], ...] = (Exception,),
+    giveup: tuple[type[BaseException], ...] = (ValueError, TypeError),
+) -> Callable:
     """
-    Attempt to call a function, if it fails, try again with a specified delay.
+    Attempt to call a function, if it fails, try again with an exponentially growing delay.
+    Failure contract: when every attempt fails with an exception in `on`, the last error is printed and None is returned;
+    an exception in `giveup`, or one not in `on`, is raised to the caller.
 
     :param retries: The max amount of retries you want for the function call
-    :param delay: The delay (in seconds) between each function retry
+    :param delay: The delay (in seconds) before the first retry, doubled after each retry plus up to 10% random jitter
+    :param on: The exceptions that trigger a retry, any other exception is raised immediately
+    :param giveup: The exceptions that are deterministic failures, they are raised immediately without retrying.
+        `on` takes precedence: a giveup class is ignored when `on` lists it or one of its subclasses,
+        e.g. retry(on=(ValueError,)) retries ValueError.
     :return:
     """
 
@@ -101,6 +184,8 @@ def retry(retries: int = 3, delay: float = 1) -> Callable:
     if retries < 1 or delay <= 0:
         raise ValueError('Are you high, mate?')
 
+    giveup = tuple(g for g in giveup if not any(issubclass(c, g) for c in on))
+
     def decorator(func: Callable) -> Callable:
         @wraps(func)
         def wrapper(*args, **kwargs) -> Any:
@@ -108,7 +193,9 @@ def retry(retries: int = 3, delay: float = 1) -> Callable:
 
                 try:
                     return func(*args, **kwargs)
-                except Exception as e:
+                except giveup:
+                    raise
+                except on as e:
                     # Break out of the loop if the max amount of retries is exceeded
                     print(f'Running ({i}): {func.__name__}()')
                     if i == retries:
@@ -117,7 +204,8 @@ def retry(retries: int = 3, delay: float = 1) -> Callable:
                         break
                     else:
                         print(f'Error: {repr(e)} -> Retrying...')
-                        time.sleep(delay)  # Add a delay before running the next iteration
+                        # Add a delay before running the next iteration, the jitter spreads out callers failing together
+                        time.sleep(delay * 2 ** (i - 1) + random.uniform(0, delay * 0.1))
 
         return wrapper
 
@@ -125,6 +213,8 @@ def retry(retries: int = 3, delay: float = 1) -> Callable:
 
 def handle_exception(func: Callable) -> Callable:
     import traceback
+    # keep the (*args, **kwargs) form: a call with wrong arguments must also fail inside the try and be reported
+    @wraps(func)
     def wrapper(*args, **kwargs):
         try:
             return func(*args, **kwargs)
@@ -135,6 +225,7 @@ def handle_exception(func: Callable) -> Callable:
             info = traceback.format_exc()
             print(info)
             print("分析报告如下.")
+            from tool.functions import query_stream
             prompt = f"请一步一步的根据下面的报错信息，分析出错的原因，请忽略Traceback (most recent call last):，以及关于wrapper的报错信息，报错信息如下：\n{info}"
             output = query_stream(prompt, max_tokens=1000, temperature=0.5)
             with open('error.md', 'w', encoding='utf-8') as f:
@@ -143,21 +234,24 @@ def handle_exception(func: Callable) -> Callable:
             return None
     return wrapper
 
-def cache(func):
-    ''' Cache the result of a function to avoid recomputing the result if the same input. '''
-    cache_ = {}
-    
-    @wraps(func)
-    def wrapper(*args, **kwargs):
-        key = (args, tuple(sorted(kwargs.items()))) 
-        if key in cache_: 
-            return cache_[key]
-        else:
-            result = func(*args, **kwargs) 
-            cache_[key] = result 
-            return result
-    
-    return wrapper
+def cache(func: Callable = None, *, maxsize: int = 1024, typed: bool = False) -> Callable:
+    '''
+    Cache the result of a function to avoid recomputing the result if the same input.
+    Backed by functools.lru_cache: keyword arguments are part of the key and only the `maxsize` most recent results are kept.
+    The key is built in C without sorting keyword arguments, so f(a=1, b=2) and f(b=2, a=1) are cached separately.
+
+    Usage:
+    @ cache
+    def f(x):
+        pass
+
+    @ cache(maxsize=None, typed=True)    # unbounded, f(1) and f(1.0) are cached separately
+    def g(x):
+        pass
+    '''
+    if func is None:
+        return lru_cache(maxsize=maxsize, typed=typed)
+    return lru_cache(maxsize=maxsize, typed=typed)(func)
 
 def trace(func):
     '''
@@ -184,12 +278,12 @@ def trace(func):
         print(f"  Positional arguments: {list(args)}")
         print(f"  Keyword arguments: {kwargs}")
 
-        start_time = time.time()
+        start_time = perf_counter_ns()
 
         result = func(*args, **kwargs)
 
-        end_time = time.time()
-        elapsed_time = end_time - start_time
+        end_time = perf_counter_ns()
+        elapsed_time = (end_time - start_time) * 1e-9
 
         print(f"{func.__name__} returned: {result}")
         print(f"Execution time: {elapsed_time:.4f} seconds\n")
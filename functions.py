@@ -1,10 +1,31 @@
 import os
 import sys
+import re
 import json
-from tqdm import tqdm
-from loguru import logger
-from typing import List, Union, Callable, Any
-from concurrent.futures import ThreadPoolExecutor
+import itertools
+from typing import List, Union, Callable, Any, Literal
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+try:
+    import orjson
+    _long_number = re.compile(rb'\d{19,}')
+
+    def _json_loads(data: bytes) -> Any:
+        '''
+        Parse with orjson, but give the input to json whenever orjson would disagree with it:
+        orjson rejects NaN / Infinity and silently turns integers beyond 64 bits into floats.
+        '''
+        if _long_number.search(data) is None:
+            try:
+                return orjson.loads(data)
+            except orjson.JSONDecodeError:
+                pass
+        return json.loads(data)
+
+    _json_dumps = orjson.dumps
+except ImportError:
+    _json_loads = json.loads
+    _json_dumps = lambda obj: json.dumps(obj, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
 
 
 def load_jsonl(file_path: str) -> list[dict]:
@@ -32,47 +53,43 @@ def load_jsonl(file_path: str) -> list[dict]:
     Returns:
         A list of dictionaries.
     '''
-    lines = open(file_path, 'r', encoding='utf-8').readlines()
-    if not lines:
-        return []
     data_list = []
 
-    try:
-        if lines[0] == '{\n':
-            json_lines = []
-            for line in lines:
-                line = line.strip()
-                if line:
-                    json_lines.append(line)
-                
-                if line == '}':
-                    json_str = ''.join(json_lines)
-                    json_obj = json.loads(json_str)
-                    data_list.append(json_obj)
-                    json_lines = []
+    with open(file_path, 'rb') as f:
+        indented = f.readline().strip() == b'{'
+        f.seek(0)
+        try:
+            if indented:
+                json_lines = []
+                for line in f:
+                    line = line.strip()
+                    if line:
+                        json_lines.append(line)
+                    
+                    if line == b'}':
+                        json_obj = _json_loads(b''.join(json_lines))
+                        data_list.append(json_obj)
+                        json_lines = []
 
-        else:
-            for line in lines:
-                line = line.strip()
-                if line:
-                    data_list.append(json.loads(line))
+            else:
+                for line in f:
+                    line = line.strip()
+                    if line:
+                        data_list.append(_json_loads(line))
 
-    except json.JSONDecodeError as e:
-        print(f'Error decoding JSON: {e}')
-        data_list = []
+        except json.JSONDecodeError as e:
+            print(f'Error decoding JSON: {e}')
+            data_list = []
 
     return data_list
 
 def debug(*args, stop=True):
     ''' Print the name, type, and value of a variable. '''
-    import inspect
-    stack = inspect.stack()
-    caller_frame_record = stack[1]
-    filename = caller_frame_record.filename
-    lineno = caller_frame_record.lineno
-    with open(filename, 'r', encoding='utf-8') as f:
-        lines = f.readlines()
-    line = lines[lineno-1].strip().replace(' ', '')
+    import linecache
+    caller_frame = sys._getframe(1)
+    filename = caller_frame.f_code.co_filename
+    lineno = caller_frame.f_lineno
+    line = linecache.getline(filename, lineno).strip().replace(' ', '')
     assert line.startswith("debug")
     left_idx = line.index('(')
     right_idx = line.rindex(')')
@@ -83,12 +100,22 @@ def debug(*args, stop=True):
     if stop:
         input()
 
+_parser_cache = {}
+
 def get_parser(language):
-    ''' Get a tree-sitter parser for a given language. '''
+    ''' Get a tree-sitter parser for a given language, the parser is built once and reused. '''
+    parser = _parser_cache.get(language)
+    if parser is not None:
+        return parser
     from tree_sitter import Language, Parser
     if not os.path.exists(f'./build/{language}-languages.so'):
         if not os.path.exists(f'./tree-sitter-{language}'):
-            os.system(f'git clone https://github.com/tree-sitter/tree-sitter-{language}')
+            import subprocess
+            subprocess.run(
+                ['git', 'clone', '--depth', '1', f'https://github.com/tree-sitter/tree-sitter-{language}', f'./tree-sitter-{language}'],
+                check=True,
+                stdout=subprocess.DEVNULL,
+            )
         Language.build_library(
             f'./build/{language}-languages.so',
             [
@@ -98,10 +125,12 @@ def get_parser(language):
     LANGUAGE = Language(f'./build/{language}-languages.so', language)
     parser = Parser()
     parser.set_language(LANGUAGE)
+    _parser_cache[language] = parser
     return parser
 
 def get_child(obj, indices: Union[int, List[int]], attribute='children'):
     ''' safely access any tree like object's child node according to the given indices path. '''
+    from loguru import logger
     current_node = obj
     if isinstance(indices, int):
         indices = [indices]
@@ -158,15 +187,16 @@ def query_stream(input,
         stream=True,  
     )
 
-    output = ''
-
+    parts = []
+    write = sys.stdout.write
     for item in response:   
         content = item.choices[0].delta.content
         if content:
-            print(content, end='')
-            output += content
-    print()
-    return output
+            write(content)
+            parts.append(content)
+    write('\n')
+    sys.stdout.flush()
+    return ''.join(parts)
 
 def no_warning():
     ''' Ignore all warnings and handle Ctrl + C simply.'''
@@ -178,6 +208,21 @@ def no_warning():
         sys.exit(0)
     signal.signal(signal.SIGINT, signal_handler)
 
+def _walk_files(path: str):
+    ''' Yield the DirEntry of every file under path in os.walk order, reusing the file type read by scandir. '''
+    subdirs = []
+    try:
+        with os.scandir(path) as it:
+            for entry in it:
+                if not entry.is_dir():
+                    yield entry
+                elif not entry.is_symlink():
+                    subdirs.append(entry.path)
+    except OSError:
+        return
+    for subdir in subdirs:
+        yield from _walk_files(subdir)
+
 def run_shell(command: str):
     '''
     ls [dir]
@@ -210,17 +255,14 @@ def run_shell(command: str):
         if not os.path.exists(dir):
             print(f"Directory {dir} not found.")
             return
-        file_list = []
         if args.recursive:
-            for root, dirs, files in os.walk(dir):
-                for file in files:
-                    file_list.append(os.path.join(root, file))
+            entries = list(_walk_files(dir))
         else:
-            file_list = os.listdir(dir)
-            file_list = [os.path.join(dir, file) for file in file_list]
+            with os.scandir(dir) as it:
+                entries = list(it)
         if args.type!= 'all':
-            file_list = [file for file in file_list if os.path.splitext(file)[1][1:] in args.type]
-        return file_list
+            entries = [entry for entry in entries if os.path.splitext(entry.name)[1][1:] in args.type]
+        return [entry.path for entry in entries]
 
     elif args[0] == 'rm':
         parser = argparse.ArgumentParser(description='Simulate a shell command.')
@@ -333,7 +375,7 @@ def run_shell(command: str):
         print(f"Command {args[0]} not recognized.")
         return False
 
-def run_in_parallel(func: Callable, *args, n: int=8) -> List[Any]:
+def run_in_parallel(func: Callable, *args, n: int=8, kind: Literal['thread', 'process', 'async']='thread') -> List[Any]:
     '''
     Usage:
         Run a function in parallel.
@@ -341,7 +383,11 @@ def run_in_parallel(func: Callable, *args, n: int=8) -> List[Any]:
     Parameters:
         :func: the function to run in parallel.
         :args: the arguments of the function.
-        :n: the number of threads to use.
+        :n: the number of workers to use.
+        :kind: how to run the function.
+            'thread': a thread pool, for I/O-bound functions.
+            'process': a process pool, for CPU-bound functions. func and its arguments must be picklable.
+            'async': func is a coroutine function, at most n calls are awaited at the same time.
         
     Returns:
         A list of the results of the function.
@@ -352,7 +398,10 @@ def run_in_parallel(func: Callable, *args, n: int=8) -> List[Any]:
 
         results = run_in_parallel(add, [1, 2, 3], [4, 5, 6], n=4)
         results = run_in_parallel(add, [1, 2, 3], 2, n=4)   equivalent to run_in_parallel(add, [1, 2, 3], [2, 2, 2], n=4)
+        results = run_in_parallel(add, [1, 2, 3], [4, 5, 6], n=4, kind='process')
     '''
+    if kind not in ('thread', 'process', 'async'):
+        raise ValueError(f"Unknown kind {kind}, expected 'thread', 'process' or 'async'")
 
     if len(args) != func.__code__.co_argcount:
         raise ValueError("Number of arguments does not match function signature")
@@ -368,12 +417,56 @@ def run_in_parallel(func: Callable, *args, n: int=8) -> List[Any]:
             new_args.append(arg)
         else:
             new_args.append([arg]*list_arg_lens[0])
-    
-    with ThreadPoolExecutor(max_workers=n) as executor:
-        results = list(tqdm(executor.map(func, *new_args), total=list_arg_lens[0]))
+    total = list_arg_lens[0]
+    from tqdm import tqdm
+
+    if kind == 'async':
+        import asyncio
+        from tqdm.asyncio import tqdm_asyncio
+
+        async def gather():
+            semaphore = asyncio.Semaphore(n)
+            async def run(*arg):
+                async with semaphore:
+                    return await func(*arg)
+            return await tqdm_asyncio.gather(*[run(*arg) for arg in zip(*new_args)], total=total)
+
+        return asyncio.run(gather())
+
+    # submit the work in batches: one future per batch keeps the dispatch (and for processes, IPC) cost
+    # off small tasks. ThreadPoolExecutor.map ignores chunksize, so the batches are built here.
+    if kind == 'thread':
+        executor_class, chunksize = ThreadPoolExecutor, max(1, total // (n * 8))
+    else:
+        executor_class, chunksize = ProcessPoolExecutor, max(1, total // (n * 4))
+    starts = iter(range(0, total, chunksize))
+    results = [None] * total
+
+    with executor_class(max_workers=n) as executor, tqdm(total=total) as pbar:
+        pending = {}
+        def submit(start):
+            future = executor.submit(_run_chunk, func, *[arg[start:start+chunksize] for arg in new_args])
+            pending[future] = start
+
+        # keep at most 2 * n batches in flight and collect whichever finishes first
+        for start in itertools.islice(starts, 2 * n):
+            submit(start)
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                start = pending.pop(future)
+                chunk_results = future.result()
+                results[start:start+len(chunk_results)] = chunk_results
+                pbar.update(len(chunk_results))
+                next_start = next(starts, None)
+                if next_start is not None:
+                    submit(next_start)
 
     return results
 
+def _run_chunk(func: Callable, *args) -> List[Any]:
+    return list(map(func, *args))
+
 def remove(s: str, sub: Union[str, List[str]]):
     '''
     Usage: